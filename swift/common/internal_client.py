@@ -13,8 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 from eventlet import sleep, Timeout
-from eventlet.green import httplib, socket
+from eventlet.green import httplib, select, socket
 import json
 import six
 from six.moves import range
@@ -26,11 +27,14 @@ from time import gmtime, strftime, time
 from zlib import compressobj
 
 from swift.common.exceptions import ClientException
-from swift.common.http import (HTTP_NOT_FOUND, HTTP_MULTIPLE_CHOICES,
-                               is_client_error, is_server_error)
+from swift.common.http import (
+    HTTP_NOT_FOUND, HTTP_MULTIPLE_CHOICES, HTTP_MOVED_PERMANENTLY, HTTP_FOUND,
+    HTTP_SEE_OTHER, HTTP_TEMPORARY_REDIRECT, is_client_error, is_server_error,
+    is_success)
 from swift.common.request_helpers import USE_REPLICATION_NETWORK_HEADER
 from swift.common.swob import Request, bytes_to_wsgi
-from swift.common.utils import quote, close_if_possible, drain_and_close
+from swift.common.utils import (
+    quote, close_if_possible, drain_and_close, FileLikeIter)
 from swift.common.wsgi import loadapp
 
 if six.PY3:
@@ -836,18 +840,205 @@ def get_auth(url, user, key, auth_version='1.0', **kwargs):
         headers.getheader('X-Auth-Token'))
 
 
+#: Statuses of the redirects that SimpleConnPool follows, as urllib does.
+REDIRECT_STATUSES = (HTTP_MOVED_PERMANENTLY, HTTP_FOUND, HTTP_SEE_OTHER,
+                     HTTP_TEMPORARY_REDIRECT)
+
+
+class PooledResponse(object):
+    """
+    Response returned by :meth:`SimpleConnPool.urlopen`, with the subset of
+    the urllib response interface that :class:`SimpleClient` uses. The body
+    has already been read so that the connection could go back to the pool.
+    """
+    def __init__(self, resp, body):
+        self.status = resp.status
+        self.headers = resp.msg
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+
+class SimpleConnPool(object):
+    """
+    Pool of keep-alive HTTP(S) connections for use with SimpleClient.
+
+    urllib closes its connection after every request; with a pool, repeated
+    requests to the same server reuse idle connections instead of paying for
+    a new TCP (and TLS) handshake each time. Connections are kept per scheme
+    and host, and an idle connection that the server has closed is discarded
+    rather than reused.
+
+    :param max_idle: maximum number of idle connections kept per host.
+    :param idle_timeout: idle connections older than this many seconds are
+                         closed instead of being reused, so that connections
+                         the server is likely to have dropped are not tried.
+    """
+    def __init__(self, max_idle=1, idle_timeout=10):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = collections.defaultdict(list)
+
+    @staticmethod
+    def _is_dropped(conn):
+        # An idle connection should have nothing to read; if its socket is
+        # readable the server has closed it (or sent something unexpected),
+        # and it can't be used for another request.
+        if conn.sock is None:
+            return False
+        try:
+            return bool(select.select([conn.sock], [], [], 0.0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def _get_conn(self, key, timeout):
+        idle = self._idle[key]
+        now = time()
+        while idle:
+            conn, last_used = idle.pop()
+            if now - last_used < self.idle_timeout and \
+                    not self._is_dropped(conn):
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            conn.close()
+        scheme, netloc = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(netloc, timeout=timeout)
+        return conn, False
+
+    def _put_conn(self, key, conn):
+        idle = self._idle[key]
+        if len(idle) < self.max_idle:
+            idle.append((conn, time()))
+        else:
+            conn.close()
+
+    def _send_iter(self, conn, method, path, headers, data):
+        # Sends each chunk the iterable yields as it is, rather than having
+        # http.client read() it back out of a file-like wrapper in small
+        # blocks.
+        header_names = set(k.lower() for k in headers)
+        chunked = 'content-length' not in header_names
+        conn.putrequest(method, path)
+        for header, value in headers.items():
+            conn.putheader(header, value)
+        if chunked and 'transfer-encoding' not in header_names:
+            conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+        for chunk in data:
+            if not chunk:
+                continue
+            if chunked:
+                conn.send(('%x\r\n' % len(chunk)).encode('ascii'))
+                conn.send(chunk)
+                conn.send(b'\r\n')
+            else:
+                conn.send(chunk)
+        if chunked:
+            conn.send(b'0\r\n\r\n')
+
+    def _request(self, method, url, headers, data, timeout):
+        parsed = urllib.parse.urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        while True:
+            conn, reused = self._get_conn(key, timeout)
+            try:
+                if data is None or isinstance(data, bytes) or \
+                        hasattr(data, 'read'):
+                    conn.request(method, path, data, headers)
+                else:
+                    self._send_iter(conn, method, path, headers, data)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                # The server may have closed the idle connection under us;
+                # if the request body can be sent again, retry it on another
+                # connection.
+                if reused and (data is None or isinstance(data, bytes)):
+                    continue
+                raise
+            break
+        if resp.will_close:
+            conn.close()
+        else:
+            self._put_conn(key, conn)
+        return resp, body
+
+    def urlopen(self, method, url, headers=None, data=None, timeout=None):
+        """
+        Makes a request on a pooled connection.
+
+        As with urllib, redirects of GET and HEAD requests are followed; a
+        redirect of any other request is raised like any other non-2xx
+        response.
+
+        :param method: HTTP method
+        :param url: absolute URL of the request
+        :param headers: dict of request headers
+        :param data: request body; bytes, a file-like object or an iterable
+                     of byte strings. An iterable body is sent with chunked
+                     transfer encoding unless a Content-Length is given.
+        :param timeout: socket timeout, in seconds
+        :returns: a :class:`PooledResponse`
+        :raises urllib2.HTTPError: if the response status is not 2xx, as
+                                   urllib does
+        """
+        headers = headers or {}
+        redirects = 0
+        while True:
+            resp, body = self._request(method, url, headers, data, timeout)
+            if resp.status not in REDIRECT_STATUSES or \
+                    method not in ('GET', 'HEAD') or \
+                    redirects >= urllib2.HTTPRedirectHandler.max_redirections:
+                break
+            location = resp.getheader('location')
+            if not location:
+                break
+            new_url = urllib.parse.urljoin(url, location)
+            if urllib.parse.urlparse(new_url).scheme not in ('http', 'https'):
+                break
+            url = new_url
+            redirects += 1
+        if not is_success(resp.status):
+            raise urllib2.HTTPError(url, resp.status, resp.reason, resp.msg,
+                                    six.BytesIO(body))
+        return PooledResponse(resp, body)
+
+
 class SimpleClient(object):
     """
     Simple client that is used in bin/swift-dispersion-* and container sync
+
+    Request contents may be bytes, a file-like object or an iterable of byte
+    strings.
+
+    :param conn_pool: optional :class:`SimpleConnPool` used for requests
+                      that do not go through a proxy.
     """
     def __init__(self, url=None, token=None, starting_backoff=1,
-                 max_backoff=5, retries=5):
+                 max_backoff=5, retries=5, conn_pool=None):
         self.url = url
         self.token = token
         self.attempts = 0  # needed in swif-dispersion-populate
         self.starting_backoff = starting_backoff
         self.max_backoff = max_backoff
         self.retries = retries
+        self.conn_pool = conn_pool
 
     def base_request(self, method, container=None, name=None, prefix=None,
                      headers=None, proxy=None, contents=None,
@@ -892,12 +1083,19 @@ class SimpleClient(object):
 
             url += '?' + '&'.join(params)
 
-        req = urllib2.Request(url, headers=headers, data=contents)
-        if proxy:
-            proxy = urllib.parse.urlparse(proxy)
-            req.set_proxy(proxy.netloc, proxy.scheme)
-        req.get_method = lambda: method
-        conn = urllib2.urlopen(req, timeout=timeout)
+        if self.conn_pool is not None and not proxy:
+            conn = self.conn_pool.urlopen(method, url, headers=headers,
+                                          data=contents, timeout=timeout)
+        else:
+            if contents is not None and not isinstance(contents, bytes) and \
+                    not hasattr(contents, 'read'):
+                contents = FileLikeIter(contents)
+            req = urllib2.Request(url, headers=headers, data=contents)
+            if proxy:
+                proxy = urllib.parse.urlparse(proxy)
+                req.set_proxy(proxy.netloc, proxy.scheme)
+            req.get_method = lambda: method
+            conn = urllib2.urlopen(req, timeout=timeout)
         body = conn.read()
         info = conn.info()
         try:
@@ -933,6 +1131,12 @@ class SimpleClient(object):
 
     def retry_request(self, method, **kwargs):
         retries = kwargs.pop('retries', self.retries)
+        contents = kwargs.get('contents')
+        if contents is not None and not isinstance(contents, bytes) and \
+                not hasattr(contents, 'read'):
+            # an iterable body is used up by the first attempt, so it can't
+            # be sent again
+            retries = 0
         self.attempts = 0
         backoff = self.starting_backoff
         while self.attempts <= retries:
@@ -970,19 +1174,19 @@ class SimpleClient(object):
                                   contents=contents.read(), **kwargs)
 
 
-def head_object(url, **kwargs):
+def head_object(url, conn_pool=None, **kwargs):
     """For usage with container sync """
-    client = SimpleClient(url=url)
+    client = SimpleClient(url=url, conn_pool=conn_pool)
     return client.retry_request('HEAD', **kwargs)
 
 
-def put_object(url, **kwargs):
+def put_object(url, conn_pool=None, **kwargs):
     """For usage with container sync """
-    client = SimpleClient(url=url)
+    client = SimpleClient(url=url, conn_pool=conn_pool)
     client.retry_request('PUT', **kwargs)
 
 
-def delete_object(url, **kwargs):
+def delete_object(url, conn_pool=None, **kwargs):
     """For usage with container sync """
-    client = SimpleClient(url=url)
+    client = SimpleClient(url=url, conn_pool=conn_pool)
     client.retry_request('DELETE', **kwargs)
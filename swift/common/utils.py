@@ -3415,20 +3415,25 @@ def audit_location_generator(devices, datadir, suffix='',
                 if hook_pre_suffix:
                     hook_pre_suffix(suff_path)
                 try:
-                    hashes = listdir(suff_path)
+                    hash_is_dir = listdir_is_dir(suff_path)
                 except OSError as e:
                     if e.errno != errno.ENOTDIR:
                         raise
                     continue
+                hashes = list(hash_is_dir)
                 if hashes_filter:
                     hashes = hashes_filter(suff_path, hashes)
                 for hsh in hashes:
                     hash_path = os.path.join(suff_path, hsh)
                     if hook_pre_hash:
                         hook_pre_hash(hash_path)
+                    is_dir = hash_is_dir.get(hsh)
                     if yield_hash_dirs:
-                        if os.path.isdir(hash_path):
+                        if is_dir or (is_dir is None and
+                                      os.path.isdir(hash_path)):
                             yield hash_path, device, partition
+                    elif is_dir is False:
+                        continue
                     else:
                         try:
                             files = sorted(listdir(hash_path), reverse=True)
@@ -3948,6 +3953,30 @@ def listdir(path):
     return []
 
 
+def listdir_is_dir(path):
+    """
+    Like :func:`listdir`, but returns a dict mapping each name in the
+    directory to whether it is a directory itself. The file types come with
+    the directory listing from os.scandir, saving a stat of each entry; where
+    os.scandir isn't available (py2) the types are not known and are None.
+
+    :param path: the directory to list
+    :returns: a dict of {name: is_dir}; empty if path doesn't exist
+    """
+    if not hasattr(os, 'scandir'):
+        return dict((name, None) for name in listdir(path))
+    try:
+        entries = os.scandir(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return {}
+    try:
+        return dict((entry.name, entry.is_dir()) for entry in entries)
+    finally:
+        entries.close()
+
+
 def streq_const_time(s1, s2):
     """Constant-time string comparison.
 
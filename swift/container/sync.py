@@ -16,12 +16,15 @@
 import collections
 import errno
 import os
+import socket
 import uuid
 from time import ctime, time
 from random import choice, random
 from struct import unpack_from
 
-from eventlet import sleep, Timeout
+from eventlet import GreenPile, sleep, Timeout
+from six.moves import http_client
+from six.moves.urllib.error import URLError
 from six.moves.urllib.parse import urlparse
 
 import swift.common.db
@@ -31,15 +34,15 @@ from swift.container.sync_store import ContainerSyncStore
 from swift.common.container_sync_realms import ContainerSyncRealms
 from swift.common.internal_client import (
     delete_object, put_object, head_object,
-    InternalClient, UnexpectedResponse)
-from swift.common.exceptions import ClientException
+    InternalClient, SimpleConnPool, UnexpectedResponse)
+from swift.common.exceptions import ClientException, LockTimeout
 from swift.common.ring import Ring
 from swift.common.ring.utils import is_local_device
 from swift.common.swob import normalize_etag
 from swift.common.utils import (
-    clean_content_type, config_true_value,
-    FileLikeIter, get_logger, hash_path, quote, validate_sync_to,
-    whataremyips, Timestamp, decode_timestamps)
+    clean_content_type, config_positive_int_value, config_true_value,
+    distribute_evenly, get_logger, hash_path, listdir, PrefixLoggerAdapter,
+    quote, validate_sync_to, whataremyips, Timestamp, decode_timestamps)
 from swift.common.daemon import Daemon
 from swift.common.http import HTTP_UNAUTHORIZED, HTTP_NOT_FOUND, HTTP_CONFLICT
 from swift.common.wsgi import ConfigString
@@ -71,6 +74,15 @@ use = egg:swift#proxy_logging
 use = egg:swift#catch_errors
 """.lstrip()
 
+#: Number of rows container_sync works through between checks of whether it
+#: has run out of time for the container; each row costs at least one network
+#: round trip so there's no need to look at the clock for every one of them.
+ROWS_PER_TIME_CHECK = 32
+
+#: Most validate_sync_to results ContainerSync keeps; the cache is emptied
+#: when it reaches this size.
+MAX_VALIDATED_SYNC_TO = 4096
+
 
 class ContainerSync(Daemon):
     """
@@ -148,6 +160,24 @@ class ContainerSync(Daemon):
         #: to the next one. If a container sync hasn't finished in this time,
         #: it'll just be resumed next scan.
         self.container_time = int(conf.get('container_time', 60))
+        #: Number of rows of a container to sync concurrently; each row costs
+        #: a GET from the local cluster and a PUT or DELETE to the remote one.
+        self.concurrency = config_positive_int_value(
+            conf.get('concurrency', 1))
+        #: Number of rows to read from a container database at a time.
+        self.row_batch_size = config_positive_int_value(
+            conf.get('row_batch_size', 512))
+        #: Number of synced rows after which the sync points are persisted
+        #: to the container database. Rows synced since the last persisted
+        #: sync point are simply synced again if the daemon is interrupted.
+        self.commit_every = config_positive_int_value(
+            conf.get('commit_every', 64))
+        #: Number of worker processes to split the local devices between;
+        #: 0 syncs all devices in the one process.
+        self.sync_workers = int(conf.get('sync_workers', 0))
+        #: Maximum time to wait for a lock on a container database before
+        #: deferring that container to the next scan.
+        self.broker_timeout = float(conf.get('broker_timeout', 5))
         #: ContainerSyncCluster instance for validating sync-to values.
         self.realms_conf = ContainerSyncRealms(
             os.path.join(
@@ -188,18 +218,32 @@ class ContainerSync(Daemon):
         self.container_stats = collections.defaultdict(int)
         self.container_stats.clear()
 
+        #: Hosts that could not be reached, mapped to the time until which
+        #: no rows are sent to them; see _host_blocked.
+        self._host_errors = {}
+
+        #: validate_sync_to results for sync_to URLs, and the
+        #: allowed_sync_hosts list they were validated against; see
+        #: _validate_sync_to.
+        self._validated_sync_to = {}
+        self._validated_sync_to_hosts = None
+
         #: Time of last stats report.
         self.reported = time()
         self.swift_dir = conf.get('swift_dir', '/etc/swift')
-        #: swift.common.ring.Ring for locating containers.
-        self.container_ring = container_ring or Ring(self.swift_dir,
-                                                     ring_name='container')
         bind_ip = conf.get('bind_ip', '0.0.0.0')
         self._myips = whataremyips(bind_ip)
         self._myport = int(conf.get('bind_port', 6201))
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
         self.conn_timeout = float(conf.get('conn_timeout', 5))
+        #: Number of seconds that no rows are sent to a remote host after a
+        #: request to it failed to get a response; 0 disables this.
+        self.error_suppression_interval = float(
+            conf.get('error_suppression_interval', 30))
+        #: Keep-alive connections to the remote clusters, shared by the rows
+        #: being synced concurrently.
+        self.conn_pool = SimpleConnPool(max_idle=self.concurrency)
         request_tries = int(conf.get('request_tries') or 3)
 
         internal_client_conf_path = conf.get('internal_client_conf_path')
@@ -225,15 +269,64 @@ class ContainerSync(Daemon):
                 'Unable to load internal client from config: '
                 '%(conf)r (%(error)s)'
                 % {'conf': internal_client_conf_path, 'error': err})
+        if container_ring is None:
+            # the internal client's proxy has normally loaded this same ring
+            # already; share it rather than keep a second copy in memory
+            container_ring = self.swift.container_ring
+            if getattr(container_ring, 'serialized_path', None) != \
+                    os.path.join(self.swift_dir, 'container.ring.gz'):
+                container_ring = Ring(self.swift_dir, ring_name='container')
+        #: swift.common.ring.Ring for locating containers.
+        self.container_ring = container_ring
 
-    def run_forever(self, *args, **kwargs):
+    def get_worker_args(self, once=False, **kwargs):
+        """
+        Splits the local devices evenly between ``sync_workers`` worker
+        processes.
+        """
+        if self.sync_workers < 1:
+            return []
+        #: The devices split between the workers; see is_healthy.
+        self.all_local_devices = sorted(listdir(self.devices))
+        self.sync_workers = min(self.sync_workers,
+                                len(self.all_local_devices))
+        return [{'override_devices': devs,
+                 'multiprocess_worker_index': index}
+                for index, devs in enumerate(
+                    distribute_evenly(self.all_local_devices,
+                                      self.sync_workers))]
+
+    def is_healthy(self):
+        """
+        Checks whether the local devices are still the ones that were split
+        between the workers; if not, the workers get restarted with the new
+        set of devices.
+        """
+        return sorted(listdir(self.devices)) == self.all_local_devices
+
+    def _emplace_log_prefix(self, worker_index):
+        self.logger = PrefixLoggerAdapter(self.logger, {})
+        self.logger.set_prefix("[worker %d/%d pid=%d] " % (
+            worker_index + 1,  # use 1-based indexing for more readable logs
+            self.sync_workers,
+            os.getpid()))
+
+    def run_forever(self, multiprocess_worker_index=None,
+                    override_devices=None, *args, **kwargs):
         """
         Runs container sync scans until stopped.
+
+        :param multiprocess_worker_index: index of this worker process, if
+                                          running as one of sync_workers
+        :param override_devices: only sync containers on these devices
         """
+        if multiprocess_worker_index is not None:
+            self._emplace_log_prefix(multiprocess_worker_index)
         sleep(random() * self.interval)
         while True:
             begin = time()
-            for path in self.sync_store.synced_containers_generator():
+            for path in self.sync_store.synced_containers_generator(
+                    devices=override_devices):
                 self.container_stats.clear()
                 self.container_sync(path)
                 if time() - self.reported >= 3600:  # once an hour
@@ -242,13 +335,21 @@ class ContainerSync(Daemon):
             if elapsed < self.interval:
                 sleep(self.interval - elapsed)
 
-    def run_once(self, *args, **kwargs):
+    def run_once(self, multiprocess_worker_index=None,
+                 override_devices=None, *args, **kwargs):
         """
         Runs a single container sync scan.
+
+        :param multiprocess_worker_index: index of this worker process, if
+                                          running as one of sync_workers
+        :param override_devices: only sync containers on these devices
         """
+        if multiprocess_worker_index is not None:
+            self._emplace_log_prefix(multiprocess_worker_index)
         self.logger.info('Begin container sync "once" mode')
         begin = time()
-        for path in self.sync_store.synced_containers_generator():
+        for path in self.sync_store.synced_containers_generator(
+                devices=override_devices):
             self.container_sync(path)
             if time() - self.reported >= 3600:  # once an hour
                 self.report()
@@ -302,6 +403,28 @@ class ContainerSync(Daemon):
                           'point2': sync_point2,
                           'total': max_row})
 
+    def _get_sync_metadata(self, broker):
+        """
+        Gets the metadata values container sync cares about from the broker.
+
+        :param broker: the container's ContainerBroker
+        :returns: a tuple of (versions_cont, sync_to, user_key) where
+                  versions_cont is True if object versioning is configured
+                  and sync_to and user_key are the values of
+                  x-container-sync-to and x-container-sync-key, or None
+        """
+        # metadata is decoded from the db on every access, so only once here
+        metadata = broker.metadata
+        versions_cont = bool(metadata.get(SYSMETA_VERSIONS_CONT))
+        sync_to = None
+        user_key = None
+        for key, (value, timestamp) in metadata.items():
+            if key.lower() == 'x-container-sync-to':
+                sync_to = value
+            elif key.lower() == 'x-container-sync-key':
+                user_key = value
+        return versions_cont, sync_to, user_key
+
     def container_sync(self, path):
         """
         Checks the given path for a container database, determines if syncing
@@ -312,7 +435,8 @@ class ContainerSync(Daemon):
         """
         broker = None
         try:
-            broker = ContainerBroker(path, logger=self.logger)
+            broker = ContainerBroker(path, timeout=self.broker_timeout,
+                                     logger=self.logger)
             # The path we pass to the ContainerBroker is a real path of
             # a container DB. If we get here, however, it means that this
             # path is linked from the sync_containers dir. In rare cases
@@ -321,7 +445,11 @@ class ContainerSync(Daemon):
             # In this case we remove the stale link and raise an error
             # since in most cases the db should be there.
             try:
-                info = broker.get_info()
+                info, is_deleted = broker.get_info_is_deleted()
+                if not info:
+                    # a missing DB is reported as deleted, with no info
+                    raise DatabaseConnectionError(broker.db_file,
+                                                  "DB doesn't exist")
             except DatabaseConnectionError as db_err:
                 if str(db_err).endswith("DB doesn't exist"):
                     self.sync_store.remove_synced_container(broker)
@@ -335,29 +463,24 @@ class ContainerSync(Daemon):
                     break
             else:
                 return
-            if broker.metadata.get(SYSMETA_VERSIONS_CONT):
+            versions_cont, sync_to, user_key = \
+                self._get_sync_metadata(broker)
+            if versions_cont:
                 self.container_skips += 1
                 self.logger.increment('skips')
                 self.logger.warning('Skipping container %s/%s with '
                                     'object versioning configured' % (
                                         info['account'], info['container']))
                 return
-            if not broker.is_deleted():
-                sync_to = None
-                user_key = None
+            if not is_deleted:
                 sync_point1 = info['x_container_sync_point1']
                 sync_point2 = info['x_container_sync_point2']
-                for key, (value, timestamp) in broker.metadata.items():
-                    if key.lower() == 'x-container-sync-to':
-                        sync_to = value
-                    elif key.lower() == 'x-container-sync-key':
-                        user_key = value
                 if not sync_to or not user_key:
                     self.container_skips += 1
                     self.logger.increment('skips')
                     return
-                err, sync_to, realm, realm_key = validate_sync_to(
-                    sync_to, self.allowed_sync_hosts, self.realms_conf)
+                err, sync_to, realm, realm_key = \
+                    self._validate_sync_to(sync_to)
                 if err:
                     self.logger.info(
                         'ERROR %(db_file)s: %(validate_sync_to_err)s',
@@ -366,18 +489,33 @@ class ContainerSync(Daemon):
                     self.container_failures += 1
                     self.logger.increment('failures')
                     return
+                # a container whose rows have all been through both stages
+                # has nothing to send
+                max_row = broker.get_max_row()
+                if min(sync_point1, sync_point2) >= max_row:
+                    self.container_syncs += 1
+                    self.logger.increment('syncs')
+                    now = time()
+                    self.container_report(now, now, sync_point1, sync_point2,
+                                          info, max_row)
+                    return
+                host = urlparse(sync_to).netloc
                 start_at = time()
                 stop_at = start_at + self.container_time
                 next_sync_point = None
                 sync_stage_time = start_at
                 try:
-                    while time() < stop_at and sync_point2 < sync_point1:
-                        rows = broker.get_items_since(sync_point2, 1)
+                    uncommitted = 0
+                    # the pass ends early if the remote host stops
+                    # responding, leaving the sync points before the rows
+                    # that weren't tried
+                    while time() < stop_at and sync_point2 < sync_point1 \
+                            and not self._host_blocked(host):
+                        rows = [row for row in broker.get_items_since(
+                                sync_point2, self.row_batch_size)
+                                if row['ROWID'] <= sync_point1]
                         if not rows:
                             break
-                        row = rows[0]
-                        if row['ROWID'] > sync_point1:
-                            break
                         # This node will only initially sync out one third
                         # of the objects (if 3 replicas, 1/4 if 4, etc.)
                         # and will skip problematic rows as needed in case of
@@ -385,53 +523,156 @@ class ContainerSync(Daemon):
                         # This section will attempt to sync previously skipped
                         # rows in case the previous attempts by any of the
                         # nodes didn't succeed.
-                        if not self.container_sync_row(
-                                row, sync_to, user_key, broker, info, realm,
-                                realm_key):
-                            if not next_sync_point:
-                                next_sync_point = sync_point2
-                        sync_point2 = row['ROWID']
-                        broker.set_x_container_sync_points(None, sync_point2)
+                        pile = GreenPile(self.concurrency)
+                        spawned_rows = []
+                        for i, row in enumerate(rows):
+                            if i and not i % ROWS_PER_TIME_CHECK and \
+                                    time() >= stop_at:
+                                break
+                            if self._host_errors and \
+                                    self._host_blocked(host):
+                                break
+                            pile.spawn(self.container_sync_row, row, sync_to,
+                                       user_key, broker, info, realm,
+                                       realm_key)
+                            spawned_rows.append(row)
+                        # results come back in the order the rows were
+                        # spawned, so the sync point only moves forward past
+                        # rows whose update has completed
+                        try:
+                            for row, success in zip(spawned_rows, pile):
+                                if success is None:
+                                    # not tried, nor were any later rows
+                                    break
+                                if not success:
+                                    if not next_sync_point:
+                                        next_sync_point = sync_point2
+                                sync_point2 = row['ROWID']
+                                uncommitted += 1
+                                # once a row has failed, sync_point2 must
+                                # stay behind it, so there's nothing more to
+                                # save
+                                if uncommitted >= self.commit_every and \
+                                        not next_sync_point:
+                                    broker.set_x_container_sync_points(
+                                        None, sync_point2)
+                                    uncommitted = 0
+                        finally:
+                            # don't leave rows of this container being sent
+                            # while the next one is synced
+                            pile.pool.waitall()
+                    # the final sync_point2 is saved along with sync_point1
+                    # below, so that a pass costs one commit to the db
                     if next_sync_point:
-                        broker.set_x_container_sync_points(None,
-                                                           next_sync_point)
+                        pending_sync_point2 = next_sync_point
                     else:
+                        pending_sync_point2 = \
+                            sync_point2 if uncommitted else None
                         next_sync_point = sync_point2
+                    uncommitted = 0
                     sync_stage_time = time()
-                    while sync_stage_time < stop_at:
-                        rows = broker.get_items_since(sync_point1, 1)
+                    while sync_stage_time < stop_at and \
+                            not self._host_blocked(host):
+                        rows = broker.get_items_since(sync_point1,
+                                                      self.row_batch_size)
                         if not rows:
                             break
-                        row = rows[0]
-                        key = hash_path(info['account'], info['container'],
-                                        row['name'], raw_digest=True)
-                        # This node will only initially sync out one third of
-                        # the objects (if 3 replicas, 1/4 if 4, etc.).
-                        # It'll come back around to the section above
-                        # and attempt to sync previously skipped rows in case
-                        # the other nodes didn't succeed or in case it failed
-                        # to do so the first time.
-                        if unpack_from('>I', key)[0] % \
-                                len(nodes) == ordinal:
-                            self.container_sync_row(
-                                row, sync_to, user_key, broker, info, realm,
-                                realm_key)
-                        sync_point1 = row['ROWID']
-                        broker.set_x_container_sync_points(sync_point1, None)
+                        pile = GreenPile(self.concurrency)
+                        batch = []
+                        for i, row in enumerate(rows):
+                            if i and not i % ROWS_PER_TIME_CHECK:
+                                sync_stage_time = time()
+                                if sync_stage_time >= stop_at:
+                                    break
+                            if self._host_errors and \
+                                    self._host_blocked(host):
+                                break
+                            key = hash_path(info['account'],
+                                            info['container'],
+                                            row['name'], raw_digest=True)
+                            # This node will only initially sync out one third
+                            # of the objects (if 3 replicas, 1/4 if 4, etc.).
+                            # It'll come back around to the section above
+                            # and attempt to sync previously skipped rows in
+                            # case the other nodes didn't succeed or in case
+                            # it failed to do so the first time.
+                            send = unpack_from('>I', key)[0] % \
+                                len(nodes) == ordinal
+                            if send:
+                                pile.spawn(self.container_sync_row, row,
+                                           sync_to, user_key, broker, info,
+                                           realm, realm_key)
+                            batch.append((row, send))
+                        # wait for the update of each row before moving the
+                        # sync point past it
+                        try:
+                            for row, sent in batch:
+                                if sent and next(pile) is None:
+                                    # not tried, nor were any later rows
+                                    break
+                                sync_point1 = row['ROWID']
+                                uncommitted += 1
+                                if uncommitted >= self.commit_every:
+                                    broker.set_x_container_sync_points(
+                                        sync_point1, pending_sync_point2)
+                                    uncommitted = 0
+                                    pending_sync_point2 = None
+                        finally:
+                            pile.pool.waitall()
                         sync_stage_time = time()
-                    self.container_syncs += 1
-                    self.logger.increment('syncs')
+                    if uncommitted or pending_sync_point2 is not None:
+                        broker.set_x_container_sync_points(
+                            sync_point1 if uncommitted else None,
+                            pending_sync_point2)
+                    if self._host_blocked(host):
+                        # rows were left untried, so this is no sync
+                        self.logger.increment('blocked')
+                    else:
+                        self.container_syncs += 1
+                        self.logger.increment('syncs')
                 finally:
                     self.container_report(start_at, sync_stage_time,
                                           sync_point1,
                                           next_sync_point,
                                           info, broker.get_max_row())
+        except LockTimeout:
+            # Some other process has the db locked; rather than hold up the
+            # scan, leave this container for the next one. The timeout's
+            # message names the db again, so it isn't logged.
+            self.logger.increment('deferrals')
+            self.logger.info('Deferring locked database %s', broker)
         except (Exception, Timeout):
             self.container_failures += 1
             self.logger.increment('failures')
             self.logger.exception('ERROR Syncing %s',
                                   broker if broker else path)
 
+    def _validate_sync_to(self, sync_to):
+        """
+        Returns the result of validate_sync_to for sync_to. Results for
+        http(s) URLs only depend on allowed_sync_hosts, so they are cached
+        until that list is replaced; //realm values are always validated
+        again as the realms conf may have been reloaded.
+
+        :param sync_to: the container's X-Container-Sync-To value
+        :returns: the tuple of (error_string, validated_endpoint, realm,
+                  realm_key) from validate_sync_to
+        """
+        if sync_to.startswith('//'):
+            return validate_sync_to(sync_to, self.allowed_sync_hosts,
+                                    self.realms_conf)
+        if self._validated_sync_to_hosts is not self.allowed_sync_hosts:
+            self._validated_sync_to.clear()
+            self._validated_sync_to_hosts = self.allowed_sync_hosts
+        result = self._validated_sync_to.get(sync_to)
+        if result is None:
+            result = validate_sync_to(sync_to, self.allowed_sync_hosts,
+                                      self.realms_conf)
+            if len(self._validated_sync_to) >= MAX_VALIDATED_SYNC_TO:
+                self._validated_sync_to.clear()
+            self._validated_sync_to[sync_to] = result
+        return result
+
     def _update_sync_to_headers(self, name, sync_to, user_key,
                                 realm, realm_key, method, headers):
         """
@@ -487,11 +728,10 @@ class ContainerSync(Daemon):
         self._update_sync_to_headers(name, sync_to, user_key, realm,
                                      realm_key, 'HEAD', headers)
         try:
-            metadata, _ = head_object(sync_to, name=name,
-                                      headers=headers,
-                                      proxy=self.select_http_proxy(),
-                                      logger=self.logger,
-                                      retries=0)
+            metadata, _ = self._remote_request(
+                head_object, sync_to, name=name, headers=headers,
+                proxy=self.select_http_proxy(), logger=self.logger,
+                retries=0)
             remote_ts = Timestamp(metadata.get('x-timestamp', 0))
             self.logger.debug("remote obj timestamp %s local obj %s" %
                               (timestamp.internal, remote_ts.internal))
@@ -525,8 +765,12 @@ class ContainerSync(Daemon):
         :param realm_key: The realm key from self.realms_conf, if there
             is one. If None, fallback to using the older
             allowed_sync_hosts way of syncing.
-        :returns: True on success
+        :returns: True on success, None if the row was not tried because the
+                  remote host is blocked; see _host_blocked.
         """
+        if self._host_errors and \
+                self._host_blocked(urlparse(sync_to).netloc):
+            return None
         try:
             start_time = time()
             # extract last modified time from the created_at value
@@ -540,10 +784,10 @@ class ContainerSync(Daemon):
                     self._update_sync_to_headers(row['name'], sync_to,
                                                  user_key, realm, realm_key,
                                                  'DELETE', headers)
-                    delete_object(sync_to, name=row['name'], headers=headers,
-                                  proxy=self.select_http_proxy(),
-                                  logger=self.logger,
-                                  timeout=self.conn_timeout)
+                    self._remote_request(
+                        delete_object, sync_to, name=row['name'],
+                        headers=headers, proxy=self.select_http_proxy(),
+                        logger=self.logger, timeout=self.conn_timeout)
                 except ClientException as err:
                     if err.http_status not in (
                             HTTP_NOT_FOUND, HTTP_CONFLICT):
@@ -609,10 +853,10 @@ class ContainerSync(Daemon):
                         headers['content-type'])
                 self._update_sync_to_headers(row['name'], sync_to, user_key,
                                              realm, realm_key, 'PUT', headers)
-                put_object(sync_to, name=row['name'], headers=headers,
-                           contents=FileLikeIter(body),
-                           proxy=self.select_http_proxy(), logger=self.logger,
-                           timeout=self.conn_timeout)
+                self._remote_request(
+                    put_object, sync_to, name=row['name'], headers=headers,
+                    contents=body, proxy=self.select_http_proxy(),
+                    logger=self.logger, timeout=self.conn_timeout)
                 self.container_puts += 1
                 self.container_stats['puts'] += 1
                 self.container_stats['bytes'] += row['size']
@@ -648,5 +892,44 @@ class ContainerSync(Daemon):
             return False
         return True
 
+    def _remote_request(self, func, sync_to, **kwargs):
+        """
+        Makes a request to the remote container with func, one of
+        head_object, put_object or delete_object. If the remote host doesn't
+        respond it is blocked for error_suppression_interval seconds; see
+        _host_blocked.
+
+        :param func: the internal_client function making the request
+        :param sync_to: The URL to the remote container.
+        :param kwargs: passed on to func
+        :returns: the result of func
+        """
+        try:
+            return func(sync_to, conn_pool=self.conn_pool, **kwargs)
+        except (socket.error, http_client.HTTPException, URLError):
+            # no response from the remote host; any error response it sent
+            # would have become a ClientException
+            if self.error_suppression_interval > 0:
+                self._host_errors[urlparse(sync_to).netloc] = \
+                    time() + self.error_suppression_interval
+            raise
+
+    def _host_blocked(self, host):
+        """
+        Checks whether rows should be kept from a remote host for now,
+        because a request to it got no response in the last
+        error_suppression_interval seconds.
+
+        :param host: the netloc of a sync_to URL
+        :returns: True if no rows should be sent to host
+        """
+        until = self._host_errors.get(host)
+        if until is None:
+            return False
+        if until > time():
+            return True
+        del self._host_errors[host]
+        return False
+
     def select_http_proxy(self):
         return choice(self.http_proxies) if self.http_proxies else None
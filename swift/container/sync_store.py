@@ -15,6 +15,7 @@
 
 import os
 import errno
+from random import shuffle
 
 from swift.common.utils import audit_location_generator, mkdirs
 from swift.container.backend import DATADIR
@@ -22,6 +23,11 @@ from swift.container.backend import DATADIR
 SYNC_DATADIR = 'sync_containers'
 
 
+def _shuffled(parent_path, names):
+    shuffle(names)
+    return names
+
+
 class ContainerSyncStore(object):
     """
     Filesystem based store for local containers that needs to be synced.
@@ -161,14 +167,30 @@ class ContainerSyncStore(object):
 
         self.remove_synced_container(broker)
 
-    def synced_containers_generator(self):
+    def synced_containers_generator(self, devices=None):
         """
         Iterates over the list of synced containers
         yielding the path of the container db
+
+        Partitions are visited in random order, as devices already are, so
+        that several processes walking the store at the same time spread
+        over different container dbs rather than contending for the same
+        ones.
+
+        :param devices: optional list of device names; if given, only
+                        containers on these devices are yielded
         """
+        if devices:
+            def devices_filter(devices_dir, device_dirs):
+                return [d for d in device_dirs if d in devices]
+        else:
+            devices_filter = None
+
         all_locs = audit_location_generator(self.devices, SYNC_DATADIR, '.db',
                                             mount_check=self.mount_check,
-                                            logger=self.logger)
+                                            logger=self.logger,
+                                            devices_filter=devices_filter,
+                                            partitions_filter=_shuffled)
         for path, device, partition in all_locs:
             # What we want to yield is the real path as its being used for
             # initiating a container broker. The broker would break if not
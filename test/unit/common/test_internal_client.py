@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import eventlet
 import json
 import mock
 import unittest
@@ -1678,6 +1679,298 @@ class TestGetAuth(unittest.TestCase):
                           'http://127.0.0.1', 'user', 'key', auth_version=2.0)
 
 
+class FakePoolConn(object):
+    def __init__(self, netloc, timeout=None):
+        self.netloc = netloc
+        self.timeout = timeout
+        self.sock = None
+        self.requests = []
+        self.responses = []
+        self.closed = False
+
+    def request(self, method, path, body, headers):
+        self.requests.append((method, path, body, headers))
+        resp = self.responses.pop(0)
+        if isinstance(resp, Exception):
+            raise resp
+        self.resp = resp
+
+    def putrequest(self, method, path):
+        self.requests.append((method, path, [], {}))
+
+    def putheader(self, header, value):
+        self.requests[-1][3][header] = value
+
+    def endheaders(self):
+        self.resp = self.responses.pop(0)
+
+    def send(self, data):
+        self.requests[-1][2].append(data)
+
+    def getresponse(self):
+        return self.resp
+
+    def close(self):
+        self.closed = True
+
+
+class FakePoolResp(object):
+    def __init__(self, status, body=b'', headers=None, will_close=False):
+        self.status = status
+        self.reason = 'Reason'
+        self.msg = headers or {}
+        self.body = body
+        self.will_close = will_close
+
+    def read(self):
+        return self.body
+
+
+class TestSimpleConnPool(unittest.TestCase):
+
+    def setUp(self):
+        self.conns = []
+        self.responses = []
+
+        def fake_conn(netloc, timeout=None):
+            conn = FakePoolConn(netloc, timeout)
+            conn.responses = self.responses
+            self.conns.append(conn)
+            return conn
+
+        patcher = mock.patch(
+            'swift.common.internal_client.httplib.HTTPConnection',
+            fake_conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reuses_connection(self):
+        pool = internal_client.SimpleConnPool()
+        self.responses.extend([
+            FakePoolResp(200, b'body', {'content-length': '4'}),
+            FakePoolResp(204)])
+        resp = pool.urlopen('HEAD', 'http://127.0.0.1:8080/v1/a/c/o?x=y',
+                            headers={'X-Foo': 'bar'}, timeout=2)
+        self.assertEqual(200, resp.getcode())
+        self.assertEqual(b'body', resp.read())
+        self.assertEqual({'content-length': '4'}, resp.info())
+        resp = pool.urlopen('DELETE', 'http://127.0.0.1:8080/v1/a/c/o2',
+                            timeout=2)
+        self.assertEqual(204, resp.getcode())
+        self.assertEqual(1, len(self.conns))
+        self.assertEqual('127.0.0.1:8080', self.conns[0].netloc)
+        self.assertEqual(2, self.conns[0].timeout)
+        self.assertEqual([
+            ('HEAD', '/v1/a/c/o?x=y', None, {'X-Foo': 'bar'}),
+            ('DELETE', '/v1/a/c/o2', None, {})], self.conns[0].requests)
+        self.assertFalse(self.conns[0].closed)
+
+    def test_will_close_not_pooled(self):
+        pool = internal_client.SimpleConnPool()
+        self.responses.extend([FakePoolResp(200, will_close=True),
+                               FakePoolResp(200)])
+        pool.urlopen('HEAD', 'http://127.0.0.1/a')
+        self.assertTrue(self.conns[0].closed)
+        pool.urlopen('HEAD', 'http://127.0.0.1/a')
+        self.assertEqual(2, len(self.conns))
+
+    def test_max_idle(self):
+        pool = internal_client.SimpleConnPool(max_idle=1)
+        conn1, reused = pool._get_conn(('http', 'host'), None)
+        self.assertFalse(reused)
+        conn2, reused = pool._get_conn(('http', 'host'), None)
+        self.assertFalse(reused)
+        pool._put_conn(('http', 'host'), conn1)
+        pool._put_conn(('http', 'host'), conn2)
+        self.assertFalse(conn1.closed)
+        self.assertTrue(conn2.closed)
+        self.assertEqual((conn1, True), pool._get_conn(('http', 'host'), 3))
+        self.assertEqual(3, conn1.timeout)
+
+    def test_idle_timeout(self):
+        pool = internal_client.SimpleConnPool(idle_timeout=10)
+        self.responses.extend([FakePoolResp(200), FakePoolResp(200)])
+        with mock.patch('swift.common.internal_client.time',
+                        return_value=100):
+            pool.urlopen('HEAD', 'http://127.0.0.1/a')
+        with mock.patch('swift.common.internal_client.time',
+                        return_value=110):
+            pool.urlopen('HEAD', 'http://127.0.0.1/a')
+        self.assertEqual(2, len(self.conns))
+        self.assertTrue(self.conns[0].closed)
+
+    def test_error_status(self):
+        pool = internal_client.SimpleConnPool()
+        self.responses.extend([FakePoolResp(404, b'not found')])
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            pool.urlopen('HEAD', 'http://127.0.0.1/a')
+        self.assertEqual(404, cm.exception.getcode())
+        # the connection is still good
+        self.assertEqual(1, len(pool._idle[('http', '127.0.0.1')]))
+
+    def test_stale_connection(self):
+        pool = internal_client.SimpleConnPool()
+        self.responses.extend([
+            FakePoolResp(200),
+            internal_client.httplib.BadStatusLine(''),
+            FakePoolResp(201)])
+        pool.urlopen('HEAD', 'http://127.0.0.1/a')
+        # bytes can be sent again on a new connection
+        resp = pool.urlopen('PUT', 'http://127.0.0.1/a', data=b'data')
+        self.assertEqual(201, resp.getcode())
+        self.assertEqual(2, len(self.conns))
+        self.assertTrue(self.conns[0].closed)
+
+        # a file-like body can not
+        self.responses.extend([IOError('broken pipe')])
+        with self.assertRaises(IOError):
+            pool.urlopen('PUT', 'http://127.0.0.1/a', data=BytesIO(b'data'))
+        self.assertTrue(self.conns[1].closed)
+
+        # and neither can a request on a new connection
+        self.responses.extend([IOError('connection refused')])
+        with self.assertRaises(IOError):
+            pool.urlopen('HEAD', 'http://127.0.0.1/a')
+        self.assertEqual(3, len(self.conns))
+
+    def test_iterable_body(self):
+        pool = internal_client.SimpleConnPool()
+        self.responses.extend([FakePoolResp(201), FakePoolResp(201)])
+        pool.urlopen('PUT', 'http://127.0.0.1/a', headers={
+            'Content-Length': '7'}, data=iter([b'abc', b'', b'defg']))
+        self.assertEqual(('PUT', '/a', [b'abc', b'defg'],
+                          {'Content-Length': '7'}),
+                         self.conns[0].requests[0])
+
+        # without a content-length the body is sent chunked
+        pool.urlopen('PUT', 'http://127.0.0.1/a', headers={'X-Foo': 'bar'},
+                     data=iter([b'abc', b'0123456789abcdef']))
+        self.assertEqual(('PUT', '/a', [
+            b'3\r\n', b'abc', b'\r\n',
+            b'10\r\n', b'0123456789abcdef', b'\r\n',
+            b'0\r\n\r\n'], {'X-Foo': 'bar',
+                            'Transfer-Encoding': 'chunked'}),
+            self.conns[0].requests[1])
+
+    def test_simple_client_iterable_body_without_pool(self):
+        with mock.patch.object(urllib2, 'urlopen') as mock_urlopen, \
+                mock.patch.object(urllib2, 'Request') as mock_request:
+            mock_urlopen.return_value.read.return_value = b''
+            internal_client.put_object('http://127.0.0.1/v1/a/c', name='o',
+                                       contents=iter([b'ab', b'cd']),
+                                       retries=0)
+        contents = mock_request.call_args[1]['data']
+        self.assertIsInstance(contents, internal_client.FileLikeIter)
+        self.assertEqual(b'abcd', contents.read())
+
+    def test_simple_client_uses_pool(self):
+        pool = internal_client.SimpleConnPool()
+        self.responses.extend([FakePoolResp(204), FakePoolResp(204)])
+        internal_client.delete_object('http://127.0.0.1/v1/a/c', name='o',
+                                      conn_pool=pool, retries=0)
+        internal_client.delete_object('http://127.0.0.1/v1/a/c', name='o',
+                                      conn_pool=pool, retries=0)
+        self.assertEqual(1, len(self.conns))
+        self.assertEqual(['/v1/a/c/o', '/v1/a/c/o'],
+                         [r[1] for r in self.conns[0].requests])
+
+        # requests through a proxy are not pooled
+        with mock.patch.object(urllib2, 'urlopen') as mock_urlopen:
+            mock_urlopen.return_value.read.return_value = b''
+            internal_client.delete_object(
+                'http://127.0.0.1/v1/a/c', name='o', conn_pool=pool,
+                proxy='http://proxy:8888', retries=0)
+        self.assertEqual(1, mock_urlopen.call_count)
+        self.assertEqual(1, len(self.conns))
+
+
+class TestSimpleConnPoolServerClose(unittest.TestCase):
+    # a real server that closes each connection once it has replied
+
+    def setUp(self):
+        self.bodies = []
+        self.requests = []
+        # path -> response status line and headers, for paths that don't get
+        # the default 201
+        self.responses = {}
+        self.server = eventlet.listen(('127.0.0.1', 0))
+        self.addCleanup(self.server.close)
+        self.server_thread = eventlet.spawn(self._serve)
+        self.addCleanup(self.server_thread.kill)
+        self.url = 'http://127.0.0.1:%d/v1/a/c' % \
+            self.server.getsockname()[1]
+
+    def _serve(self):
+        while True:
+            sock, _addr = self.server.accept()
+            fp = sock.makefile('rb')
+            content_length = 0
+            method, path, _version = fp.readline().split(b' ', 2)
+            self.requests.append((method, path))
+            line = fp.readline()
+            while line not in (b'\r\n', b''):
+                name, _, value = line.partition(b':')
+                if name.lower() == b'content-length':
+                    content_length = int(value)
+                line = fp.readline()
+            self.bodies.append(fp.read(content_length))
+            status = self.responses.get(path, b'HTTP/1.1 201 Created\r\n')
+            sock.sendall(status + b'Content-Length: 0\r\n\r\n')
+            fp.close()
+            sock.close()
+
+    def test_server_closed_idle_connection(self):
+        pool = internal_client.SimpleConnPool()
+        for i in range(3):
+            internal_client.put_object(
+                self.url, name='o', headers={'Content-Length': '4'},
+                contents=iter([b'abcd']), conn_pool=pool, timeout=2)
+            # let the server close the connection that went back to the pool
+            eventlet.sleep(0.01)
+        self.assertEqual([b'abcd'] * 3, self.bodies)
+
+    def test_redirect(self):
+        pool = internal_client.SimpleConnPool()
+        self.responses[b'/v1/a/c/o'] = (
+            b'HTTP/1.1 301 Moved Permanently\r\n'
+            b'Location: /v1/a/c/moved\r\n')
+        # HEADs and GETs are redirected, as urllib does
+        internal_client.head_object(self.url, name='o', conn_pool=pool,
+                                    timeout=2)
+        self.assertEqual([(b'HEAD', b'/v1/a/c/o'),
+                          (b'HEAD', b'/v1/a/c/moved')], self.requests)
+
+        # but other requests are not, and the redirect isn't retried
+        del self.requests[:]
+        with self.assertRaises(exceptions.ClientException) as cm:
+            internal_client.delete_object(self.url, name='o', conn_pool=pool,
+                                          timeout=2, retries=0)
+        self.assertEqual(301, cm.exception.http_status)
+        self.assertEqual([(b'DELETE', b'/v1/a/c/o')], self.requests)
+
+    def test_redirect_loop(self):
+        pool = internal_client.SimpleConnPool()
+        self.responses[b'/v1/a/c/o'] = (
+            b'HTTP/1.1 302 Found\r\n'
+            b'Location: %s/o\r\n' % self.url.encode('ascii'))
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            pool.urlopen('GET', self.url + '/o', timeout=2)
+        self.assertEqual(302, cm.exception.code)
+        self.assertEqual(
+            urllib2.HTTPRedirectHandler.max_redirections + 1,
+            len(self.requests))
+
+    def test_iterable_body_not_retried(self):
+        client = internal_client.SimpleClient(url=self.url, retries=5)
+        with mock.patch.object(internal_client.SimpleClient, 'base_request',
+                               side_effect=IOError('boom')) as mock_request:
+            with self.assertRaises(IOError):
+                client.retry_request('PUT', name='o',
+                                     contents=iter([b'abcd']))
+        self.assertEqual(1, mock_request.call_count)
+        self.assertEqual(1, client.attempts)
+
+
 class TestSimpleClient(unittest.TestCase):
 
     def _test_get_head(self, request, urlopen, method):
@@ -6314,6 +6314,7 @@ class TestAuditLocationGenerator(unittest.TestCase):
 
     def test_drive_tree_access(self):
         orig_listdir = utils.listdir
+        orig_listdir_is_dir = utils.listdir_is_dir
 
         def _mock_utils_listdir(path):
             if 'bad_part' in path:
@@ -6325,6 +6326,11 @@ class TestAuditLocationGenerator(unittest.TestCase):
             else:
                 return orig_listdir(path)
 
+        def _mock_utils_listdir_is_dir(path):
+            if 'bad_suffix' in path:
+                raise OSError(errno.EACCES)
+            return orig_listdir_is_dir(path)
+
         # Check Raise on Bad partition
         tmpdir = mkdtemp()
         data = os.path.join(tmpdir, "drive", "data")
@@ -6355,7 +6361,8 @@ class TestAuditLocationGenerator(unittest.TestCase):
             pass
         suffix = os.path.join(part2, "suffix")
         os.makedirs(suffix)
-        with patch('swift.common.utils.listdir', _mock_utils_listdir):
+        with patch('swift.common.utils.listdir_is_dir',
+                   _mock_utils_listdir_is_dir):
             audit = lambda: list(utils.audit_location_generator(
                 tmpdir, "data", mount_check=False))
             self.assertRaises(OSError, audit)
@@ -6371,9 +6378,7 @@ class TestAuditLocationGenerator(unittest.TestCase):
         os.makedirs(suffix)
         hash1 = os.path.join(suffix, "hash1")
         os.makedirs(hash1)
-        obj_path = os.path.join(suffix, "bad_hash")
-        with open(obj_path, 'w'):
-            pass
+        os.makedirs(os.path.join(suffix, "bad_hash"))
         with patch('swift.common.utils.listdir', _mock_utils_listdir):
             audit = lambda: list(utils.audit_location_generator(
                 tmpdir, "data", mount_check=False))
@@ -6580,7 +6585,9 @@ class TestAuditLocationGenerator(unittest.TestCase):
 
             # Return the list of devices
 
-            with patch('os.listdir', side_effect=os.listdir) as m_listdir:
+            with patch('os.listdir', side_effect=os.listdir) as m_listdir, \
+                    patch('swift.common.utils.listdir_is_dir',
+                          side_effect=utils.listdir_is_dir) as m_is_dir:
                 # devices_filter
                 m_listdir.reset_mock()
                 devices_filter = MagicMock(return_value=["drive"])
@@ -6612,17 +6619,17 @@ class TestAuditLocationGenerator(unittest.TestCase):
                 self.assertNotIn(((partition,),), m_listdir.call_args_list)
 
                 # suffixes_filter
-                m_listdir.reset_mock()
+                m_is_dir.reset_mock()
                 suffixes_filter = MagicMock(return_value=["suffix1"])
                 list(audit_location_generator(suffixes_filter=suffixes_filter))
                 suffixes_filter.assert_called_once_with(partition, ["suffix1"])
-                self.assertIn(((suffix,),), m_listdir.call_args_list)
+                self.assertIn(((suffix,),), m_is_dir.call_args_list)
 
-                m_listdir.reset_mock()
+                m_is_dir.reset_mock()
                 suffixes_filter = MagicMock(return_value=[])
                 list(audit_location_generator(suffixes_filter=suffixes_filter))
                 suffixes_filter.assert_called_once_with(partition, ["suffix1"])
-                self.assertNotIn(((suffix,),), m_listdir.call_args_list)
+                self.assertNotIn(((suffix,),), m_is_dir.call_args_list)
 
                 # hashes_filter
                 m_listdir.reset_mock()
@@ -6637,6 +6644,47 @@ class TestAuditLocationGenerator(unittest.TestCase):
                 hashes_filter.assert_called_once_with(suffix, ["hash1"])
                 self.assertNotIn(((hash_path,),), m_listdir.call_args_list)
 
+    @with_tempdir
+    def test_listdir_is_dir(self, tmpdir):
+        os.makedirs(os.path.join(tmpdir, 'adir'))
+        with open(os.path.join(tmpdir, 'afile'), 'w'):
+            pass
+        expected = {'adir': True, 'afile': False}
+        if not hasattr(os, 'scandir'):
+            expected = {'adir': None, 'afile': None}
+        self.assertEqual(expected, utils.listdir_is_dir(tmpdir))
+        self.assertEqual(
+            {}, utils.listdir_is_dir(os.path.join(tmpdir, 'missing')))
+        with self.assertRaises(OSError) as cm:
+            utils.listdir_is_dir(os.path.join(tmpdir, 'afile'))
+        self.assertEqual(errno.ENOTDIR, cm.exception.errno)
+
+    @unittest.skipIf(not hasattr(os, 'scandir'), 'needs os.scandir')
+    @with_tempdir
+    def test_hash_dirs_need_no_stat(self, tmpdir):
+        suffix = os.path.join(tmpdir, 'drive', 'data', 'part', 'suffix')
+        hash_path = os.path.join(suffix, 'hash')
+        os.makedirs(hash_path)
+        with open(os.path.join(hash_path, 'obj.db'), 'w'):
+            pass
+        with open(os.path.join(suffix, 'not_a_hash'), 'w'):
+            pass
+        with patch('os.path.isdir', side_effect=os.path.isdir) as m_isdir, \
+                patch('os.listdir', side_effect=os.listdir) as m_listdir:
+            self.assertEqual(
+                [(hash_path, 'drive', 'part')],
+                list(utils.audit_location_generator(
+                    tmpdir, 'data', mount_check=False,
+                    yield_hash_dirs=True)))
+            self.assertEqual(
+                [(os.path.join(hash_path, 'obj.db'), 'drive', 'part')],
+                list(utils.audit_location_generator(
+                    tmpdir, 'data', mount_check=False)))
+        m_isdir.assert_not_called()
+        # the file among the hash dirs is never listed
+        self.assertNotIn(((os.path.join(suffix, 'not_a_hash'),),),
+                         m_listdir.call_args_list)
+
     @with_tempdir
     def test_error_counter(self, tmpdir):
         def assert_no_errors(devices, mount_check=False):
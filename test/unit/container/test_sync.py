@@ -15,18 +15,21 @@
 # limitations under the License.
 
 import os
+import socket
 import unittest
 from textwrap import dedent
 
+import eventlet
 import mock
 import errno
 from swift.common.utils import Timestamp, readconf
 from test.debug_logger import debug_logger
 from swift.container import sync
 from swift.common.db import DatabaseConnectionError
+from swift.container.backend import ContainerBroker
 from swift.common import utils
 from swift.common.wsgi import ConfigString
-from swift.common.exceptions import ClientException
+from swift.common.exceptions import ClientException, LockTimeout
 from swift.common.storage_policy import StoragePolicy
 import test
 from test.unit import patch_policies, with_tempdir
@@ -67,6 +70,9 @@ class FakeContainerBroker(object):
     def is_deleted(self):
         return self.deleted
 
+    def get_info_is_deleted(self):
+        return self.info, self.deleted
+
     def get_items_since(self, sync_point, limit):
         if sync_point < 0:
             sync_point = 0
@@ -86,7 +92,7 @@ class TestContainerSync(unittest.TestCase):
     def test_FileLikeIter(self):
         # Retained test to show new FileLikeIter acts just like the removed
         # _Iter2FileLikeObject did.
-        flo = sync.FileLikeIter(iter([b'123', b'4567', b'89', b'0']))
+        flo = utils.FileLikeIter(iter([b'123', b'4567', b'89', b'0']))
         expect = b'1234567890'
 
         got = flo.read(2)
@@ -103,7 +109,7 @@ class TestContainerSync(unittest.TestCase):
         self.assertEqual(flo.read(), b'')
         self.assertEqual(flo.read(2), b'')
 
-        flo = sync.FileLikeIter(iter([b'123', b'4567', b'89', b'0']))
+        flo = utils.FileLikeIter(iter([b'123', b'4567', b'89', b'0']))
         self.assertEqual(flo.read(), b'1234567890')
         self.assertEqual(flo.read(), b'')
         self.assertEqual(flo.read(2), b'')
@@ -160,6 +166,25 @@ class TestContainerSync(unittest.TestCase):
         expected_conf.pop('__file__')
         self.assertEqual(expected_conf, actual_conf)
 
+    def test_init_shares_internal_client_container_ring(self):
+        with mock.patch('swift.container.sync.InternalClient') as mock_ic, \
+                mock.patch('swift.container.sync.Ring') as mock_ring:
+            mock_ic.return_value.container_ring.serialized_path = \
+                '/etc/swift/container.ring.gz'
+            cs = sync.ContainerSync({})
+        self.assertIs(cs.container_ring, mock_ic.return_value.container_ring)
+        mock_ring.assert_not_called()
+
+        # the internal client may be configured with another swift_dir
+        with mock.patch('swift.container.sync.InternalClient') as mock_ic, \
+                mock.patch('swift.container.sync.Ring') as mock_ring:
+            mock_ic.return_value.container_ring.serialized_path = \
+                '/etc/swift/container.ring.gz'
+            cs = sync.ContainerSync({'swift_dir': '/other/swift'})
+        self.assertIs(cs.container_ring, mock_ring.return_value)
+        mock_ring.assert_called_once_with('/other/swift',
+                                          ring_name='container')
+
     def test_init_internal_client_log_name(self):
         def _do_test_init_ic_log_name(conf, exp_internal_client_log_name):
             with mock.patch(
@@ -209,7 +234,7 @@ class TestContainerSync(unittest.TestCase):
                 mock.patch('swift.container.sync.sleep', fake_sleep), \
                 mock.patch(gen_func) as fake_generator, \
                 mock.patch('swift.container.sync.ContainerBroker',
-                           lambda p, logger: FakeContainerBroker(p, info={
+                           lambda p, **kw: FakeContainerBroker(p, info={
                                'account': 'a', 'container': 'c',
                                'storage_policy_index': 0})):
             fake_generator.side_effect = [iter(['container.db']),
@@ -255,7 +280,7 @@ class TestContainerSync(unittest.TestCase):
                 mock.patch('swift.container.sync.time', fake_time), \
                 mock.patch(gen_func) as fake_generator, \
                 mock.patch('swift.container.sync.ContainerBroker',
-                           lambda p, logger: FakeContainerBroker(p, info={
+                           lambda p, **kw: FakeContainerBroker(p, info={
                                'account': 'a', 'container': 'c',
                                'storage_policy_index': 0})):
             fake_generator.side_effect = [iter(['container.db']),
@@ -275,6 +300,50 @@ class TestContainerSync(unittest.TestCase):
             self.assertEqual(2, fake_generator.call_count)
             self.assertEqual(cs.reported, 3604)
 
+    @with_tempdir
+    def test_get_worker_args(self, tempdir):
+        for dev in ('sda', 'sdb', 'sdc'):
+            os.mkdir(os.path.join(tempdir, dev))
+        conf = {'devices': tempdir}
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync(conf, container_ring=FakeRing())
+        self.assertEqual([], cs.get_worker_args())
+
+        conf['sync_workers'] = '2'
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync(conf, container_ring=FakeRing())
+        self.assertEqual([
+            {'override_devices': ['sda', 'sdc'],
+             'multiprocess_worker_index': 0},
+            {'override_devices': ['sdb'],
+             'multiprocess_worker_index': 1},
+        ], cs.get_worker_args())
+        self.assertTrue(cs.is_healthy())
+        os.mkdir(os.path.join(tempdir, 'sdd'))
+        self.assertFalse(cs.is_healthy())
+
+        # never more workers than devices
+        conf['sync_workers'] = '10'
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync(conf, container_ring=FakeRing())
+        self.assertEqual(4, len(cs.get_worker_args(once=True)))
+        self.assertEqual(4, cs.sync_workers)
+
+    def test_run_once_override_devices(self):
+        gen_func = ('swift.container.sync_store.'
+                    'ContainerSyncStore.synced_containers_generator')
+        with mock.patch('swift.container.sync.InternalClient'), \
+                mock.patch(gen_func) as fake_generator:
+            fake_generator.return_value = iter([])
+            cs = sync.ContainerSync({'sync_workers': '2'},
+                                    container_ring=FakeRing(),
+                                    logger=self.logger)
+            cs.run_once(multiprocess_worker_index=1,
+                        override_devices=['sdb'])
+        fake_generator.assert_called_once_with(devices=['sdb'])
+        for line in self.logger.get_lines_for_level('info'):
+            self.assertIn('[worker 2/2 pid=%d] ' % os.getpid(), line)
+
     def test_container_sync_not_db(self):
         cring = FakeRing()
         with mock.patch('swift.container.sync.InternalClient'):
@@ -296,7 +365,7 @@ class TestContainerSync(unittest.TestCase):
 
         # Test the case where get_info returns DatabaseConnectionError
         # with DB does not exist, and we succeed in deleting it.
-        with mock.patch(broker + '.get_info') as fake_get_info:
+        with mock.patch(broker + '.get_info_is_deleted') as fake_get_info:
             with mock.patch(store + '.remove_synced_container') as fake_remove:
                 fake_get_info.side_effect = DatabaseConnectionError(
                     'a',
@@ -309,7 +378,7 @@ class TestContainerSync(unittest.TestCase):
 
         # Test the case where get_info returns DatabaseConnectionError
         # with DB does not exist, and we fail to delete it.
-        with mock.patch(broker + '.get_info') as fake_get_info:
+        with mock.patch(broker + '.get_info_is_deleted') as fake_get_info:
             with mock.patch(store + '.remove_synced_container') as fake_remove:
                 fake_get_info.side_effect = DatabaseConnectionError(
                     'a',
@@ -323,7 +392,7 @@ class TestContainerSync(unittest.TestCase):
 
         # Test the case where get_info returns DatabaseConnectionError
         # with DB does not exist, and it returns an error != ENOENT.
-        with mock.patch(broker + '.get_info') as fake_get_info:
+        with mock.patch(broker + '.get_info_is_deleted') as fake_get_info:
             with mock.patch(store + '.remove_synced_container') as fake_remove:
                 fake_get_info.side_effect = DatabaseConnectionError(
                     'a',
@@ -337,7 +406,7 @@ class TestContainerSync(unittest.TestCase):
 
         # Test the case where get_info returns DatabaseConnectionError
         # error different than DB does not exist
-        with mock.patch(broker + '.get_info') as fake_get_info:
+        with mock.patch(broker + '.get_info_is_deleted') as fake_get_info:
             with mock.patch(store + '.remove_synced_container') as fake_remove:
                 fake_get_info.side_effect = DatabaseConnectionError('a', 'a')
                 cs.container_sync('isa.db')
@@ -345,6 +414,28 @@ class TestContainerSync(unittest.TestCase):
                 self.assertEqual(cs.container_skips, 0)
                 self.assertEqual(0, fake_remove.call_count)
 
+    def test_container_sync_locked_db(self):
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync({'broker_timeout': '0.5'},
+                                    container_ring=FakeRing(),
+                                    logger=self.logger)
+        self.assertEqual(0.5, cs.broker_timeout)
+        fcb = FakeContainerBroker('path')
+        # no timeout given, so no timer is left to fire in a later test
+        fcb.get_info_is_deleted = mock.Mock(side_effect=LockTimeout())
+        with mock.patch('swift.container.sync.ContainerBroker',
+                        return_value=fcb) as mock_broker:
+            cs.container_sync('isa.db')
+        mock_broker.assert_called_once_with('isa.db', timeout=0.5,
+                                            logger=self.logger)
+        # a locked db is deferred to the next scan, not counted as failed
+        self.assertEqual(0, cs.container_failures)
+        self.assertEqual({'deferrals': 1},
+                         self.logger.get_increment_counts())
+        self.assertFalse(self.logger.get_lines_for_level('error'))
+        self.assertEqual(['Deferring locked database %s' % fcb],
+                         self.logger.get_lines_for_level('info'))
+
     def test_container_sync_not_my_db(self):
         # Db could be there due to handoff replication so test that we ignore
         # those.
@@ -357,7 +448,7 @@ class TestContainerSync(unittest.TestCase):
             self.assertEqual(['10.0.0.0'], cs._myips)
         orig_ContainerBroker = sync.ContainerBroker
         try:
-            sync.ContainerBroker = lambda p, logger: FakeContainerBroker(
+            sync.ContainerBroker = lambda p, **kw: FakeContainerBroker(
                 p, info={'account': 'a', 'container': 'c',
                          'storage_policy_index': 0})
             cs._myips = ['127.0.0.1']   # No match
@@ -390,7 +481,7 @@ class TestContainerSync(unittest.TestCase):
             cs = sync.ContainerSync({}, container_ring=cring)
         orig_ContainerBroker = sync.ContainerBroker
         try:
-            sync.ContainerBroker = lambda p, logger: FakeContainerBroker(
+            sync.ContainerBroker = lambda p, **kw: FakeContainerBroker(
                 p, info={'account': 'a', 'container': 'c',
                          'storage_policy_index': 0}, deleted=False)
             cs._myips = ['10.0.0.0']    # Match
@@ -400,7 +491,7 @@ class TestContainerSync(unittest.TestCase):
             cs.container_sync('isa.db')
             self.assertEqual(cs.container_failures, 1)
 
-            sync.ContainerBroker = lambda p, logger: FakeContainerBroker(
+            sync.ContainerBroker = lambda p, **kw: FakeContainerBroker(
                 p, info={'account': 'a', 'container': 'c',
                          'storage_policy_index': 0}, deleted=True)
             # This complete match will not cause any more container failures
@@ -410,13 +501,99 @@ class TestContainerSync(unittest.TestCase):
         finally:
             sync.ContainerBroker = orig_ContainerBroker
 
+    @with_tempdir
+    def test_container_sync_reads_info_once(self, tempdir):
+        db_path = os.path.join(tempdir, 'container.db')
+        broker = ContainerBroker(db_path, account='a', container='c')
+        broker.initialize(Timestamp(1).internal, 0)
+        broker.update_metadata({
+            'X-Container-Sync-To': ['http://127.0.0.1/a/c',
+                                    Timestamp(1).internal],
+            'X-Container-Sync-Key': ['key', Timestamp(1).internal]})
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync({}, container_ring=FakeRing(),
+                                    logger=self.logger)
+        cs._myips = ['10.0.0.0']    # Match
+        cs._myport = 1000           # Match
+        cs.allowed_sync_hosts = ['127.0.0.1']
+        with mock.patch.object(ContainerBroker, 'get_info',
+                               autospec=True,
+                               side_effect=ContainerBroker.get_info) as \
+                mock_get_info, \
+                mock.patch.object(ContainerBroker, 'is_deleted') as \
+                mock_is_deleted:
+            cs.container_sync(db_path)
+        self.assertEqual(1, mock_get_info.call_count)
+        mock_is_deleted.assert_not_called()
+        self.assertEqual(1, cs.container_syncs)
+        self.assertEqual(0, cs.container_failures)
+
+    def test_container_sync_up_to_date(self):
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync({}, container_ring=FakeRing(),
+                                    logger=self.logger)
+        cs._myips = ['10.0.0.0']    # Match
+        cs._myport = 1000           # Match
+
+        cs.allowed_sync_hosts = ['127.0.0.1']
+
+        def do_sync(sync_point1, sync_point2,
+                    sync_metadata=(False, 'http://127.0.0.1/a/c', 'key')):
+            fcb = FakeContainerBroker(
+                'path',
+                info={'account': 'a', 'container': 'c',
+                      'storage_policy_index': 0,
+                      'x_container_sync_point1': sync_point1,
+                      'x_container_sync_point2': sync_point2},
+                items_since=[{'ROWID': 1, 'name': 'o', 'created_at': '1.2',
+                              'deleted': True}])
+            with mock.patch('swift.container.sync.ContainerBroker',
+                            lambda p, **kw: fcb), \
+                    mock.patch.object(cs, '_get_sync_metadata',
+                                      return_value=sync_metadata), \
+                    mock.patch('swift.container.sync.delete_object'), \
+                    mock.patch.object(fcb, 'get_items_since',
+                                      side_effect=fcb.get_items_since) as \
+                    mock_items:
+                cs.container_sync('isa.db')
+            return mock_items.call_count
+
+        # both sync points have reached the last row (get_max_row is 1)
+        self.assertEqual(0, do_sync(1, 1))
+        self.assertEqual(1, cs.container_syncs)
+        self.assertEqual(1, len(self.logger.get_lines_for_level('info')))
+        # rows still to be retried behind sync_point1
+        self.assertTrue(do_sync(1, -1))
+        # rows after sync_point1
+        self.assertTrue(do_sync(-1, -1))
+        self.assertEqual(3, cs.container_syncs)
+        self.assertEqual(0, cs.container_failures)
+        self.assertEqual(0, cs.container_skips)
+        # containers that would be skipped still are, however idle
+        self.assertEqual(0, do_sync(1, 1, (True, 'http://127.0.0.1/a/c',
+                                           'key')))
+        self.assertEqual(0, do_sync(1, 1, (False, 'http://127.0.0.1/a/c',
+                                           None)))
+        self.assertEqual(3, cs.container_syncs)
+        self.assertEqual(2, cs.container_skips)
+        self.assertIn('object versioning configured',
+                      self.logger.get_lines_for_level('warning')[-1])
+        # and an idle container with a sync_to that's no longer allowed
+        # still fails
+        self.assertEqual(0, do_sync(1, 1, (False, 'http://10.9.9.9/a/c',
+                                           'key')))
+        self.assertEqual(3, cs.container_syncs)
+        self.assertEqual(1, cs.container_failures)
+        self.assertIn('Invalid host', self.logger.get_lines_for_level(
+            'info')[-1])
+
     def test_container_sync_no_to_or_key(self):
         cring = FakeRing()
         with mock.patch('swift.container.sync.InternalClient'):
             cs = sync.ContainerSync({}, container_ring=cring)
         orig_ContainerBroker = sync.ContainerBroker
         try:
-            sync.ContainerBroker = lambda p, logger: FakeContainerBroker(
+            sync.ContainerBroker = lambda p, **kw: FakeContainerBroker(
                 p, info={'account': 'a', 'container': 'c',
                          'storage_policy_index': 0,
                          'x_container_sync_point1': -1,
@@ -429,7 +606,7 @@ class TestContainerSync(unittest.TestCase):
             self.assertEqual(cs.container_failures, 0)
             self.assertEqual(cs.container_skips, 1)
 
-            sync.ContainerBroker = lambda p, logger: FakeContainerBroker(
+            sync.ContainerBroker = lambda p, **kw: FakeContainerBroker(
                 p, info={'account': 'a', 'container': 'c',
                          'storage_policy_index': 0,
                          'x_container_sync_point1': -1,
@@ -443,7 +620,7 @@ class TestContainerSync(unittest.TestCase):
             self.assertEqual(cs.container_failures, 0)
             self.assertEqual(cs.container_skips, 2)
 
-            sync.ContainerBroker = lambda p, logger: FakeContainerBroker(
+            sync.ContainerBroker = lambda p, **kw: FakeContainerBroker(
                 p, info={'account': 'a', 'container': 'c',
                          'storage_policy_index': 0,
                          'x_container_sync_point1': -1,
@@ -457,7 +634,7 @@ class TestContainerSync(unittest.TestCase):
             self.assertEqual(cs.container_failures, 0)
             self.assertEqual(cs.container_skips, 3)
 
-            sync.ContainerBroker = lambda p, logger: FakeContainerBroker(
+            sync.ContainerBroker = lambda p, **kw: FakeContainerBroker(
                 p, info={'account': 'a', 'container': 'c',
                          'storage_policy_index': 0,
                          'x_container_sync_point1': -1,
@@ -473,7 +650,7 @@ class TestContainerSync(unittest.TestCase):
             self.assertEqual(cs.container_failures, 1)
             self.assertEqual(cs.container_skips, 3)
 
-            sync.ContainerBroker = lambda p, logger: FakeContainerBroker(
+            sync.ContainerBroker = lambda p, **kw: FakeContainerBroker(
                 p, info={'account': 'a', 'container': 'c',
                          'storage_policy_index': 0,
                          'x_container_sync_point1': -1,
@@ -498,7 +675,7 @@ class TestContainerSync(unittest.TestCase):
         orig_ContainerBroker = sync.ContainerBroker
         orig_time = sync.time
         try:
-            sync.ContainerBroker = lambda p, logger: FakeContainerBroker(
+            sync.ContainerBroker = lambda p, **kw: FakeContainerBroker(
                 p, info={'account': 'a', 'container': 'c',
                          'storage_policy_index': 0,
                          'x_container_sync_point1': -1,
@@ -535,6 +712,46 @@ class TestContainerSync(unittest.TestCase):
             sync.ContainerBroker = orig_ContainerBroker
             sync.time = orig_time
 
+    def test_container_stop_at_checks_time_every_few_rows(self):
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync({}, container_ring=FakeRing(),
+                                    logger=self.logger)
+        fcb = FakeContainerBroker(
+            'path',
+            info={'account': 'a', 'container': 'c',
+                  'storage_policy_index': 0,
+                  'x_container_sync_point1': -1,
+                  'x_container_sync_point2': -1},
+            metadata={'x-container-sync-to': ('http://127.0.0.1/a/c', 1),
+                      'x-container-sync-key': ('key', 1)},
+            items_since=[{'ROWID': i, 'name': 'o%d' % i}
+                         for i in range(1, 41)])
+
+        def fake_hash_path(account, container, obj, raw_digest=False):
+            # Ensures that no rows match for second loop, ordinal is 0 and
+            # all hashes are 1
+            return b'\x01' * 16
+
+        fake_times = [
+            0,      # Compute the time to move on
+            0,      # Compute if it's time to move on from first loop
+            0,      # Start of the second loop
+            1000,   # Checked after ROWS_PER_TIME_CHECK rows
+            1000]   # End of the batch
+        with mock.patch('swift.container.sync.ContainerBroker',
+                        lambda p, **kw: fcb), \
+                mock.patch('swift.container.sync.hash_path',
+                           fake_hash_path), \
+                mock.patch('swift.container.sync.time',
+                           side_effect=fake_times) as mock_time:
+            cs._myips = ['10.0.0.0']    # Match
+            cs._myport = 1000           # Match
+            cs.allowed_sync_hosts = ['127.0.0.1']
+            cs.container_sync('isa.db')
+        self.assertEqual(5, mock_time.call_count)
+        self.assertEqual(0, cs.container_failures)
+        self.assertEqual(sync.ROWS_PER_TIME_CHECK, fcb.sync_point1)
+
     def test_container_first_loop(self):
         cring = FakeRing()
         with mock.patch('swift.container.sync.InternalClient'):
@@ -554,7 +771,7 @@ class TestContainerSync(unittest.TestCase):
                       'x-container-sync-key': ('key', 1)},
             items_since=[{'ROWID': 1, 'name': 'o'}])
         with mock.patch('swift.container.sync.ContainerBroker',
-                        lambda p, logger: fcb), \
+                        lambda p, **kw: fcb), \
                 mock.patch('swift.container.sync.hash_path', fake_hash_path):
             cs._myips = ['10.0.0.0']    # Match
             cs._myport = 1000           # Match
@@ -581,7 +798,7 @@ class TestContainerSync(unittest.TestCase):
                                             ('key', 1)},
                                   items_since=[{'ROWID': 1, 'name': 'o'}])
         with mock.patch('swift.container.sync.ContainerBroker',
-                        lambda p, logger: fcb), \
+                        lambda p, **kw: fcb), \
                 mock.patch('swift.container.sync.hash_path', fake_hash_path):
             cs._myips = ['10.0.0.0']    # Match
             cs._myport = 1000           # Match
@@ -603,7 +820,7 @@ class TestContainerSync(unittest.TestCase):
                       'x-container-sync-key': ('key', 1)},
             items_since=[{'ROWID': 1, 'name': 'o'}])
         with mock.patch('swift.container.sync.ContainerBroker',
-                        lambda p, logger: fcb):
+                        lambda p, **kw: fcb):
             cs._myips = ['10.0.0.0']    # Match
             cs._myport = 1000           # Match
             cs.allowed_sync_hosts = ['127.0.0.1']
@@ -628,7 +845,7 @@ class TestContainerSync(unittest.TestCase):
             items_since=[{'ROWID': 1, 'name': 'o', 'created_at': '1.2',
                           'deleted': True}])
         with mock.patch('swift.container.sync.ContainerBroker',
-                        lambda p, logger: fcb), \
+                        lambda p, **kw: fcb), \
                 mock.patch('swift.container.sync.delete_object',
                            fake_delete_object):
             cs._myips = ['10.0.0.0']    # Match
@@ -652,7 +869,7 @@ class TestContainerSync(unittest.TestCase):
             items_since=[{'ROWID': 1, 'name': 'o', 'created_at': '1.2',
                           'deleted': True}])
         with mock.patch('swift.container.sync.ContainerBroker',
-                        lambda p, logger: fcb), \
+                        lambda p, **kw: fcb), \
                 mock.patch('swift.container.sync.delete_object',
                            lambda *x, **y: None):
             cs._myips = ['10.0.0.0']    # Match
@@ -692,7 +909,7 @@ class TestContainerSync(unittest.TestCase):
                 metadata={'x-container-sync-to': ('http://127.0.0.1/a/c', 1),
                           'x-container-sync-key': ('key', 1)},
                 items_since=[{'ROWID': 1, 'name': 'o'}])
-            sync.ContainerBroker = lambda p, logger: fcb
+            sync.ContainerBroker = lambda p, **kw: fcb
             cs._myips = ['10.0.0.0']    # Match
             cs._myport = 1000           # Match
             cs.allowed_sync_hosts = ['127.0.0.1']
@@ -722,7 +939,7 @@ class TestContainerSync(unittest.TestCase):
                 metadata={'x-container-sync-to': ('http://127.0.0.1/a/c', 1),
                           'x-container-sync-key': ('key', 1)},
                 items_since=[{'ROWID': 1, 'name': 'o'}])
-            sync.ContainerBroker = lambda p, logger: fcb
+            sync.ContainerBroker = lambda p, **kw: fcb
             cs._myips = ['10.0.0.0']    # Match
             cs._myport = 1000           # Match
             cs.allowed_sync_hosts = ['127.0.0.1']
@@ -744,7 +961,7 @@ class TestContainerSync(unittest.TestCase):
                           'x-container-sync-key': ('key', 1)},
                 items_since=[{'ROWID': 1, 'name': 'o', 'created_at': '1.2',
                               'deleted': True}])
-            sync.ContainerBroker = lambda p, logger: fcb
+            sync.ContainerBroker = lambda p, **kw: fcb
             cs._myips = ['10.0.0.0']    # Match
             cs._myport = 1000           # Match
             cs.allowed_sync_hosts = ['127.0.0.1']
@@ -760,6 +977,207 @@ class TestContainerSync(unittest.TestCase):
             sync.hash_path = orig_hash_path
             sync.delete_object = orig_delete_object
 
+    def test_container_sync_concurrency(self):
+        cring = FakeRing()
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync({'concurrency': '3'}, container_ring=cring,
+                                    logger=self.logger)
+        self.assertEqual(3, cs.concurrency)
+        fcb = FakeContainerBroker(
+            'path',
+            info={'account': 'a', 'container': 'c',
+                  'storage_policy_index': 0,
+                  'x_container_sync_point1': 3,
+                  'x_container_sync_point2': -1},
+            metadata={'x-container-sync-to': ('http://127.0.0.1/a/c', 1),
+                      'x-container-sync-key': ('key', 1)},
+            items_since=[{'ROWID': 1, 'name': 'o1'},
+                         {'ROWID': 2, 'name': 'o2'},
+                         {'ROWID': 3, 'name': 'o3'}])
+        calls = []
+
+        def fake_container_sync_row(row, *args):
+            calls.append(('start', row['name']))
+            eventlet.sleep(0)
+            calls.append(('end', row['name']))
+            return row['name'] != 'o2'
+
+        with mock.patch('swift.container.sync.ContainerBroker',
+                        lambda p, **kw: fcb), \
+                mock.patch.object(cs, 'container_sync_row',
+                                  fake_container_sync_row):
+            cs._myips = ['10.0.0.0']    # Match
+            cs._myport = 1000           # Match
+            cs.allowed_sync_hosts = ['127.0.0.1']
+            cs.container_sync('isa.db')
+        # all three rows were in flight at the same time
+        self.assertEqual([('start', 'o1'), ('start', 'o2'), ('start', 'o3')],
+                         calls[:3])
+        self.assertEqual(0, cs.container_failures)
+        # the sync point is left just before the failed row
+        self.assertIsNone(fcb.sync_point1)
+        self.assertEqual(1, fcb.sync_point2)
+
+    def test_container_sync_invalid_concurrency(self):
+        for conf in ({'concurrency': '0'}, {'concurrency': '-1'},
+                     {'row_batch_size': '0'}, {'row_batch_size': 'x'},
+                     {'commit_every': '0'}, {'commit_every': '-1'}):
+            with mock.patch('swift.container.sync.InternalClient'), \
+                    self.assertRaises(ValueError):
+                sync.ContainerSync(conf, container_ring=FakeRing(),
+                                   logger=self.logger)
+
+    def test_container_sync_waits_for_rows_on_error(self):
+        cring = FakeRing()
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync({'concurrency': '3', 'commit_every': '1'},
+                                    container_ring=cring, logger=self.logger)
+        fcb = FakeContainerBroker(
+            'path',
+            info={'account': 'a', 'container': 'c',
+                  'storage_policy_index': 0,
+                  'x_container_sync_point1': 3,
+                  'x_container_sync_point2': -1},
+            metadata={'x-container-sync-to': ('http://127.0.0.1/a/c', 1),
+                      'x-container-sync-key': ('key', 1)},
+            items_since=[{'ROWID': 1, 'name': 'o1'},
+                         {'ROWID': 2, 'name': 'o2'},
+                         {'ROWID': 3, 'name': 'o3'}])
+        finished = []
+
+        def fake_container_sync_row(row, *args):
+            if row['name'] != 'o1':
+                eventlet.sleep(0.01)
+            finished.append(row['name'])
+            return True
+
+        with mock.patch('swift.container.sync.ContainerBroker',
+                        lambda p, **kw: fcb), \
+                mock.patch.object(cs, 'container_sync_row',
+                                  fake_container_sync_row), \
+                mock.patch.object(fcb, 'set_x_container_sync_points',
+                                  side_effect=Exception('boom')):
+            cs._myips = ['10.0.0.0']    # Match
+            cs._myport = 1000           # Match
+            cs.allowed_sync_hosts = ['127.0.0.1']
+            cs.container_sync('isa.db')
+        self.assertEqual(1, cs.container_failures)
+        # no row is left being sent once the container is done with
+        self.assertEqual(['o1', 'o2', 'o3'], finished)
+
+    def test_container_sync_batches(self):
+        cring = FakeRing()
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync({'row_batch_size': '2',
+                                     'commit_every': '3'},
+                                    container_ring=cring, logger=self.logger)
+        self.assertEqual(2, cs.row_batch_size)
+        self.assertEqual(3, cs.commit_every)
+        fcb = FakeContainerBroker(
+            'path',
+            info={'account': 'a', 'container': 'c',
+                  'storage_policy_index': 0,
+                  'x_container_sync_point1': -1,
+                  'x_container_sync_point2': -1},
+            metadata={'x-container-sync-to': ('http://127.0.0.1/a/c', 1),
+                      'x-container-sync-key': ('key', 1)},
+            items_since=[{'ROWID': i, 'name': 'o%d' % i,
+                          'created_at': '1.2', 'deleted': True}
+                         for i in range(1, 6)])
+
+        def fake_hash_path(account, container, obj, raw_digest=False):
+            # Ensures that all rows match for second loop, ordinal is 0 and
+            # all hashes are 0
+            return b'\x00' * 16
+
+        with mock.patch('swift.container.sync.ContainerBroker',
+                        lambda p, **kw: fcb), \
+                mock.patch('swift.container.sync.hash_path',
+                           fake_hash_path), \
+                mock.patch('swift.container.sync.delete_object') as mock_del, \
+                mock.patch.object(fcb, 'get_items_since',
+                                  side_effect=fcb.get_items_since) as \
+                mock_items, \
+                mock.patch.object(fcb, 'set_x_container_sync_points',
+                                  side_effect=fcb.set_x_container_sync_points
+                                  ) as mock_set:
+            cs._myips = ['10.0.0.0']    # Match
+            cs._myport = 1000           # Match
+            cs.allowed_sync_hosts = ['127.0.0.1']
+            cs.container_sync('isa.db')
+        self.assertEqual(0, cs.container_failures)
+        self.assertEqual(5, mock_del.call_count)
+        self.assertEqual([mock.call(-1, 2), mock.call(2, 2), mock.call(4, 2),
+                          mock.call(5, 2)], mock_items.mock_calls)
+        self.assertEqual([mock.call(3, None), mock.call(5, None)],
+                         mock_set.mock_calls)
+
+    def _do_container_sync_both_stages(self, conf, fail_rows=()):
+        cring = FakeRing()
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync(conf, container_ring=cring,
+                                    logger=self.logger)
+        fcb = FakeContainerBroker(
+            'path',
+            info={'account': 'a', 'container': 'c',
+                  'storage_policy_index': 0,
+                  'x_container_sync_point1': 3,
+                  'x_container_sync_point2': -1},
+            metadata={'x-container-sync-to': ('http://127.0.0.1/a/c', 1),
+                      'x-container-sync-key': ('key', 1)},
+            items_since=[{'ROWID': i, 'name': 'o%d' % i,
+                          'created_at': '1.2', 'deleted': True}
+                         for i in range(1, 6)])
+
+        def fake_hash_path(account, container, obj, raw_digest=False):
+            return b'\x00' * 16
+
+        def fake_delete_object(sync_to, name=None, **kwargs):
+            if name in fail_rows:
+                raise Exception('boom')
+
+        with mock.patch('swift.container.sync.ContainerBroker',
+                        lambda p, **kw: fcb), \
+                mock.patch('swift.container.sync.hash_path',
+                           fake_hash_path), \
+                mock.patch('swift.container.sync.delete_object',
+                           fake_delete_object), \
+                mock.patch.object(fcb, 'set_x_container_sync_points',
+                                  side_effect=fcb.set_x_container_sync_points
+                                  ) as mock_set:
+            cs._myips = ['10.0.0.0']    # Match
+            cs._myport = 1000           # Match
+            cs.allowed_sync_hosts = ['127.0.0.1']
+            cs.container_sync('isa.db')
+        return cs, mock_set.mock_calls
+
+    def test_container_sync_saves_both_sync_points_at_once(self):
+        cs, set_calls = self._do_container_sync_both_stages({})
+        self.assertEqual(0, cs.container_failures)
+        self.assertEqual([mock.call(5, 3)], set_calls)
+
+    def test_container_sync_does_not_save_sync_point2_past_failure(self):
+        cs, set_calls = self._do_container_sync_both_stages(
+            {'commit_every': '1'}, fail_rows=('o2',))
+        self.assertEqual(1, cs.container_failures)
+        # sync_point2 stays at the row before the failed one
+        self.assertEqual([mock.call(None, 1), mock.call(4, 1),
+                          mock.call(5, None)], set_calls)
+
+    def test_get_sync_metadata(self):
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync({}, container_ring=FakeRing(),
+                                    logger=self.logger)
+        broker = FakeContainerBroker('path', metadata={
+            'X-Container-Sync-To': ('http://127.0.0.1/a/c', 1),
+            'x-container-sync-key': ('key', 1),
+            'X-Container-Meta-Foo': ('bar', 1)})
+        self.assertEqual((False, 'http://127.0.0.1/a/c', 'key'),
+                         cs._get_sync_metadata(broker))
+
+        broker.metadata = {sync.SYSMETA_VERSIONS_CONT: ('versions', 1)}
+        self.assertEqual((True, None, None), cs._get_sync_metadata(broker))
+
     def test_container_report(self):
         container_stats = {'puts': 0,
                            'deletes': 0,
@@ -800,7 +1218,7 @@ class TestContainerSync(unittest.TestCase):
                 mock.patch('swift.container.sync.hash_path',
                            fake_hash_path), \
                 mock.patch('swift.container.sync.ContainerBroker',
-                           lambda p, logger: fcb):
+                           lambda p, **kw: fcb):
             cring = FakeRing()
             cs = sync.ContainerSync({}, container_ring=cring,
                                     logger=self.logger)
@@ -822,6 +1240,133 @@ class TestContainerSync(unittest.TestCase):
             self.assertEqual('posts: 0', lines.pop().strip())
             self.assertEqual('puts: 0', lines.pop().strip())
 
+    def test_container_sync_row_blocks_unreachable_host(self):
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync({'error_suppression_interval': '30'},
+                                    container_ring=FakeRing(),
+                                    logger=self.logger)
+        self.assertEqual(30, cs.error_suppression_interval)
+        info = {'account': 'a', 'container': 'c', 'storage_policy_index': 0}
+
+        def do_row(deleted=True, sync_to='http://sync/to/path'):
+            return cs.container_sync_row(
+                {'deleted': deleted, 'name': 'object',
+                 'created_at': Timestamp(1.1).internal, 'size': '1000'},
+                sync_to, 'key', FakeContainerBroker('broker'), info,
+                None, None)
+
+        with mock.patch('swift.container.sync.delete_object',
+                        side_effect=socket.error('refused')) as mock_del, \
+                mock.patch('swift.container.sync.time', return_value=100):
+            self.assertFalse(do_row())
+            self.assertEqual(1, mock_del.call_count)
+            self.assertEqual({'sync': 130}, cs._host_errors)
+            self.assertTrue(cs._host_blocked('sync'))
+            self.assertFalse(cs._host_blocked('other'))
+        self.assertEqual(1, cs.container_failures)
+        # the block ends after error_suppression_interval
+        with mock.patch('swift.container.sync.time', return_value=130):
+            self.assertFalse(cs._host_blocked('sync'))
+        self.assertEqual({}, cs._host_errors)
+
+        # an error response from the host isn't held against it
+        with mock.patch('swift.container.sync.delete_object',
+                        side_effect=ClientException(
+                            'boom', http_status=503)):
+            self.assertFalse(do_row())
+        self.assertEqual({}, cs._host_errors)
+
+        # nor is an error getting the local object
+        cs.swift.get_object.side_effect = OSError('local trouble')
+        with mock.patch('swift.container.sync.head_object',
+                        side_effect=ClientException(
+                            'not found', http_status=404)):
+            self.assertFalse(do_row(deleted=False))
+        self.assertEqual({}, cs._host_errors)
+        self.assertEqual(3, cs.container_failures)
+
+    def test_container_sync_stops_at_unreachable_host(self):
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync({'commit_every': '1'},
+                                    container_ring=FakeRing(),
+                                    logger=self.logger)
+        fcb = FakeContainerBroker(
+            'path',
+            info={'account': 'a', 'container': 'c',
+                  'storage_policy_index': 0,
+                  'x_container_sync_point1': -1,
+                  'x_container_sync_point2': -1},
+            metadata={'x-container-sync-to': ('http://127.0.0.1/a/c', 1),
+                      'x-container-sync-key': ('key', 1)},
+            items_since=[{'ROWID': i, 'name': 'o%d' % i,
+                          'created_at': '1.2', 'deleted': True}
+                         for i in range(1, 5001)])
+        fcb.get_max_row = lambda: 5000
+
+        def fake_hash_path(account, container, obj, raw_digest=False):
+            return b'\x00' * 16
+
+        with mock.patch('swift.container.sync.ContainerBroker',
+                        lambda p, **kw: fcb), \
+                mock.patch('swift.container.sync.hash_path',
+                           fake_hash_path), \
+                mock.patch('swift.container.sync.delete_object',
+                           side_effect=socket.error('refused')) as mock_del:
+            cs._myips = ['10.0.0.0']    # Match
+            cs._myport = 1000           # Match
+            cs.allowed_sync_hosts = ['127.0.0.1']
+            cs.container_sync('isa.db')
+            self.assertEqual(1, mock_del.call_count)
+            # the failed row was passed; the rest of the backlog wasn't
+            self.assertEqual(1, fcb.sync_point1)
+            self.assertEqual(1, cs.container_failures)
+            self.assertEqual(0, cs.container_syncs)
+
+            # while the host is blocked the container isn't worked on
+            cs.container_sync('isa.db')
+            self.assertEqual(1, mock_del.call_count)
+            self.assertEqual(1, cs.container_failures)
+            # nor is the pass counted as a sync
+            self.assertEqual(0, cs.container_syncs)
+            self.assertEqual(2, self.logger.get_increment_counts()['blocked'])
+            self.assertNotIn('syncs', self.logger.get_increment_counts())
+
+    def test_validate_sync_to_cached(self):
+        with mock.patch('swift.container.sync.InternalClient'):
+            cs = sync.ContainerSync({}, container_ring=FakeRing(),
+                                    logger=self.logger)
+        cs.allowed_sync_hosts = ['127.0.0.1']
+        with mock.patch('swift.container.sync.validate_sync_to',
+                        wraps=sync.validate_sync_to) as mock_validate:
+            for _ in range(3):
+                self.assertEqual(
+                    (None, 'http://127.0.0.1/a/c', None, None),
+                    cs._validate_sync_to('http://127.0.0.1/a/c'))
+            self.assertEqual(1, mock_validate.call_count)
+            # errors are cached too
+            for _ in range(2):
+                err = cs._validate_sync_to('http://10.0.0.1/a/c')[0]
+                self.assertIn('Invalid host', err)
+            self.assertEqual(2, mock_validate.call_count)
+            # replacing the allowed hosts empties the cache
+            cs.allowed_sync_hosts = ['10.0.0.1']
+            self.assertEqual(
+                (None, 'http://10.0.0.1/a/c', None, None),
+                cs._validate_sync_to('http://10.0.0.1/a/c'))
+            self.assertEqual(3, mock_validate.call_count)
+            self.assertIn('Invalid host',
+                          cs._validate_sync_to('http://127.0.0.1/a/c')[0])
+            self.assertEqual(4, mock_validate.call_count)
+            self.assertEqual(2, len(cs._validated_sync_to))
+            # realms may be reloaded so are never cached
+            for _ in range(2):
+                cs._validate_sync_to('//US/cluster/a/c')
+            self.assertEqual(6, mock_validate.call_count)
+
+        with mock.patch('swift.container.sync.MAX_VALIDATED_SYNC_TO', 2):
+            cs._validate_sync_to('http://10.0.0.1/a/c2')
+            self.assertEqual(1, len(cs._validated_sync_to))
+
     def test_container_sync_row_delete(self):
         self._test_container_sync_row_delete(None, None)
 
@@ -840,7 +1385,7 @@ class TestContainerSync(unittest.TestCase):
             ts_data = Timestamp(1.1)
 
             def fake_delete_object(path, name=None, headers=None, proxy=None,
-                                   logger=None, timeout=None):
+                                   logger=None, timeout=None, conn_pool=None):
                 self.assertEqual(path, 'http://sync/to/path')
                 self.assertEqual(name, 'object')
                 if realm:
@@ -856,6 +1401,7 @@ class TestContainerSync(unittest.TestCase):
                 self.assertEqual(proxy, 'http://proxy')
                 self.assertEqual(timeout, 5.0)
                 self.assertEqual(logger, self.logger)
+                self.assertIs(conn_pool, cs.conn_pool)
 
             sync.delete_object = fake_delete_object
 
@@ -977,7 +1523,7 @@ class TestContainerSync(unittest.TestCase):
 
             def check_put_object(extra_headers, sync_to, name=None,
                                  headers=None, contents=None, proxy=None,
-                                 logger=None, timeout=None):
+                                 logger=None, timeout=None, conn_pool=None):
                 self.assertEqual(sync_to, 'http://sync/to/path')
                 self.assertEqual(name, 'object')
                 expected_headers = {
@@ -994,10 +1540,11 @@ class TestContainerSync(unittest.TestCase):
                         'x-container-sync-key': 'key'})
                 expected_headers.update(extra_headers)
                 self.assertDictEqual(expected_headers, headers)
-                self.assertEqual(contents.read(), b'contents')
+                self.assertEqual(b''.join(contents), b'contents')
                 self.assertEqual(proxy, 'http://proxy')
                 self.assertEqual(timeout, 5.0)
                 self.assertEqual(logger, self.logger)
+                self.assertIs(conn_pool, cs.conn_pool)
 
             sync.put_object = fake_put_object
             expected_put_count = 0
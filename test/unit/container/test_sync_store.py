@@ -264,6 +264,43 @@ class TestContainerSyncStore(unittest.TestCase):
         self.assertEqual(
             set(containers), set(iterated_synced_containers))
 
+    def test_iterate_synced_containers_on_devices(self):
+        sds = sync_store.ContainerSyncStore(self.devices_dir,
+                                            self.logger,
+                                            False)
+        containers = list()
+        for i in range(10):
+            cfile = self.pick_dbfile()
+            broker = FakeContainerBroker(cfile)
+            sds.add_synced_container(broker)
+            containers.append(cfile)
+
+        devices = ['sdax', 'sdc']
+        iterated_synced_containers = list(
+            sds.synced_containers_generator(devices=devices))
+        self.assertEqual(
+            set(c for c in containers
+                if c[len(self.devices_dir):].split('/')[0] in devices),
+            set(iterated_synced_containers))
+
+    def test_iterate_synced_containers_shuffles_partitions(self):
+        sds = sync_store.ContainerSyncStore(self.devices_dir,
+                                            self.logger,
+                                            False)
+        for device in self.devices:
+            for part in self.partitions:
+                cfile = os.path.join(self.devices_dir, device, DATADIR, part,
+                                     self.suffixes[0], self.hashes[0],
+                                     '%s.db' % self.hashes[0])
+                sds.add_synced_container(FakeContainerBroker(cfile))
+
+        with mock.patch('swift.container.sync_store.shuffle') as \
+                mock_shuffle:
+            list(sds.synced_containers_generator())
+        self.assertEqual(len(self.devices), mock_shuffle.call_count)
+        for call in mock_shuffle.call_args_list:
+            self.assertEqual(sorted(self.partitions), sorted(call[0][0]))
+
     def test_unhandled_exceptions_in_add_remove(self):
         sds = sync_store.ContainerSyncStore(self.devices_dir,
                                             self.logger,